@@ -13,6 +13,8 @@ files are defined in one directory
 import subprocess as sp 
 import os 
 import argparse
+from collections import deque
+from pipeline_tools import start_pipeline, finish_file
 ## Define the argument parsers
 #-----------------------------
 parser=argparse.ArgumentParser(description="A Python script that acts as a wrapper for the underlining executable, i.e. ppg\
@@ -25,59 +27,71 @@ parser.add_argument('--output_path', help="The path to the base directory where
     default='?' )
 parser.add_argument('--ref_path', help="The path to the reference Fasta file used for generating the results", 
      default='?' )
+parser.add_argument('--pipeline_depth',help="The number of input files processed at the same time, while ppg translates one file,\
+    bcftools can decode the next one, defaults to 2", default=2, type=int)
 parser.add_argument('--no_module',help="A boolean flag for whether or not to load the bcftools module, if set the command, module load bcftools will not be executed",
-        type='bool',action='store_true')
+        action='store_true')
 args=parser.parse_args()
 ## Validate user input   
 #---------------------
 input_path_base=args.input_path
-if not os.path.exists(input_path_base):
-    raise ValueError(f"The input path to files: {input_path_base} is not defined")
 output_path_base=args.output_path
-if not os.path.exists(input_path_base):
-    try: 
-        os.mkdir(input_path_base)
-    except Exception as exp:
-        raise ValueError(f"The provided path to write the write does not exist!!, also creating an exception at the specified path failed with the following error: {exp}")
 Reference_name=args.ref_path
-if not os.path.exists(input_path_base):
-    raise ValueError(f"The provided path for the reference sequence: {Reference_name} does not exists !!")
+for path, path_name in ((input_path_base,'input path to files'),(output_path_base,'output path'),(Reference_name,'path for the reference sequence')):
+    if path=='?':
+        raise ValueError(f"The {path_name} has not been provided")
+# the output directory itself is created below, hence only its parent has to exist 
+for path, path_name in ((input_path_base,'input path to files'),(os.path.dirname(os.path.abspath(output_path_base)),'parent of the output path'),
+                        (Reference_name,'path for the reference sequence')):
+    if not os.path.exists(path):
+        raise ValueError(f"The provided {path_name}: {path} does not exists !!")
+try: 
+    os.makedirs(output_path_base,exist_ok=True)
+except Exception as exp:
+    raise ValueError(f"Creating the output directory at the specified path: {output_path_base} failed with the following error: {exp}")
 no_module=args.no_module
+if args.pipeline_depth<1:
+    raise ValueError(f"The provided pipeline depth: {args.pipeline_depth} must be at least 1")
+## Resolve the path to bcftools once
+#------------------------------------
+try:
+    if no_module:
+        BCFTOOLS=sp.check_output('command -v bcftools', shell=True, text=True, executable='/bin/bash').strip()
+    else:
+        BCFTOOLS=sp.check_output('module load bcftools; command -v bcftools', shell=True, text=True, executable='/bin/bash').strip()
+except sp.SubprocessError as exp:
+    raise RuntimeError(f"Finding the bcftools executable failed with the following error: {str(exp)}")
 ## GET NAMES OF THE INPUT FILES
 #------------------------------
-input_files=[input_file for input_file in os.listdir(input_path_base) if ('bcf.gz' in input_file and 'csi' not in input_file)]
+with os.scandir(input_path_base) as dir_entries:
+    input_files=[entry.name for entry in dir_entries if entry.is_file() and entry.name.endswith('.bcf.gz')]
+## TOKENIZE THE COMMANDS ONCE
+#-----------------------------
+bcftools_argv=[BCFTOOLS,'view','-O','v']
+ppg_argv=['./ppg_rust','-f','/dev/stdin','-r',Reference_name,'-g','mt','-vs']
 ## LOOP OVER THE INPUT FILE AND CALL ppg
 #----------------------------------------
+# up to pipeline_depth files are in flight, so decoding the next file overlaps with translating the current one
+running=deque()
 for input_file in input_files:
+    if len(running)>=args.pipeline_depth:
+        finish_file(*running.popleft())
     print(f'Generatating personalized proteomes from: {input_file} ...')
+    # build the paths used by the current file once 
+    stem=input_file.split('.',1)[0]
+    out_dir=f'{output_path_base}/{stem}_protoems'
+    log_path=f'{output_path_base}/{stem}.vcfDebug_logs' # the vcf is streamed into ppg, its name is only used for naming the logs
     # create a file to hold the results 
-    output_path=os.path.join(output_path_base,input_file.split('.')[0])
     try: 
-        os.mkdir(output_path+"_protoems") # make the output file 
-    except FileExistsError: 
-        pass
+        os.makedirs(out_dir,exist_ok=True) # make the output file 
     except Exception as exp: 
         print(f'While creating a file to hold the results of file: {input_file} the following error was encounter {str(exp)}')
-    # generating the vcf_file
-    vcf_file_name=input_file.split('.')[0]+'.vcf'
-    # generate the file 
-    try:
-        if no_module:
-            sp.run(f'bcftools view {os.path.join(input_path_base,input_file)} -O v -o {os.path.join(output_path_base,vcf_file_name)}',
-            check=True, shell=True)
-        else:
-            sp.run(f'module load bcftools; bcftools view {os.path.join(input_path_base,input_file)} -O v -o {os.path.join(output_path_base,vcf_file_name)}',
-            check=True, shell=True)
-    except sp.SubprocessError as exp: 
-        print(f'Trying to generate the vcf file failed with the following error: {str(exp)}')
-        continue
-    # call ppg
+    # decode the bcf file and stream it directly into ppg, no intermediate vcf file is written to disk
     try: 
-        sp.run(f"./ppg_rust -f {os.path.join(output_path_base,vcf_file_name)} -r {Reference_name} -o {output_path+'_protoems'} -g mt -vs &> {os.path.join(output_path_base,vcf_file_name+'Debug_logs')} ", 
-            check=True, shell=True)
-    except sp.SubprocessError as exp: 
+        running.append((input_file,start_pipeline([bcftools_argv+[f'{input_path_base}/{input_file}'],ppg_argv+['-o',out_dir]],log_path)))
+    except OSError as exp: 
         print(f'Trying to generate the personalized proteomes failed with the following error:{str(exp)}')
         pass 
-    # remove the file: 
-    os.system(f'rm -rf {os.path.join(output_path_base,vcf_file_name)}')
+while running:
+    finish_file(*running.popleft())
 print(f'Execution finished')
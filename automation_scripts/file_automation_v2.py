@@ -6,63 +6,88 @@
 ## Load the modules
 #------------------
 import os 
-import pandas as pd
+import shutil
 import subprocess as sp
+import tempfile
+from collections import deque
+from pipeline_tools import start_pipeline, finish_file
 ## Define Path to load the data
 #------------------------------
 
 OUTPUT_PATH='/work_ifs/sukmb418/human_exome2/predictions_final/fasta'
-TEMP_DIR='/work_ifs/sukmb418/human_exome2/predictions_final/fasta'
+# the transcript patterns are read by every file of the run on the same host, hence, they are kept in memory on tmpfs
+# the directory is shared by all jobs on the host, each run writes its own uniquely named pattern file to it  
+TEMP_DIR=os.environ.get('VCF2PROT_TMP','/dev/shm/vcf2prot')
+# debug logs are written to the node local scratch instead of the networked file system
+LOG_DIR=os.environ.get('VCF2PROT_LOG_DIR',os.environ.get('TMPDIR','/tmp'))
 INPUT_PATH='/work_ifs/sukmb361/2020~2021_HLA_IBD/HLA_IBD_Exome/csq'
 LIST_SAMPLES='/work_ifs/sukmb418/human_exome2/sample_sheet.txt'
 LIST_TRANS='/work_ifs/sukmb418/human_exome2/predictions_final/ENST_filtered.csv'
 REF_PATH='/work_ifs/sukmb418/human_exome2/predictions_final/target_fasta.fasta'
+os.makedirs(TEMP_DIR,exist_ok=True)
+os.makedirs(LOG_DIR,exist_ok=True)
+## Resolve the path to bcftools once
+#------------------------------------
+try:
+    BCFTOOLS=sp.check_output('module load bcftools; command -v bcftools', shell=True, text=True, executable='/bin/bash').strip()
+except sp.SubprocessError as exp:
+    raise RuntimeError(f"Finding the bcftools executable failed with the following error: {str(exp)}")
+# the number of input files processed at the same time, while ppg translates one file, bcftools can decode the next one
+PIPELINE_DEPTH=2
+# bgzf decompression scales with the number of threads, hence, the cores available to the job are shared among the files in flight
+AVAILABLE_CORES=len(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else os.cpu_count()
+NUM_THREADS=max(1,AVAILABLE_CORES//PIPELINE_DEPTH)
 
 ## Load the dataset
 #-----------------
-txp_list=pd.read_csv(LIST_TRANS,sep=' ').iloc[:,1].to_list()
+with open(LIST_TRANS) as reader_file:
+    next(reader_file) # skip the header line 
+    txp_list=[line.rstrip('\n').split(' ')[1] for line in reader_file if line.strip()]
+# write the transcripts as fixed-string patterns, '#' is added to keep the header lines
+pattern_fd, pattern_file=tempfile.mkstemp(prefix='target_transcripts_',suffix='_patterns.txt',dir=TEMP_DIR)
+with os.fdopen(pattern_fd,'w') as writer_file:
+    writer_file.write('\n'.join(['#']+txp_list)+'\n')
+# ripgrep multi-literal matching is considerably faster than grep, fall back to grep if it is not installed
+LITERAL_GREP=['rg','-F','--no-line-number'] if shutil.which('rg') is not None else ['grep','-F']
 
 ## GET The Input VCF 
 #------------------------------
-input_files=[input_file for input_file in os.listdir(INPUT_PATH) if ('bcf.gz' in input_file and 'csi' not in input_file)]
+with os.scandir(INPUT_PATH) as dir_entries:
+    input_files=[entry.name for entry in dir_entries if entry.is_file() and entry.name.endswith('.bcf.gz')]
+
+## Tokenize the commands once
+#-----------------------------
+bcftools_argv=[BCFTOOLS,'view','-S',LIST_SAMPLES,'--threads',str(NUM_THREADS),'-O','v']
+grep_argv=LITERAL_GREP+['-f',pattern_file]
+ppg_argv=['./Vcf2prot','-f','/dev/stdin','-r',REF_PATH,'-g','mt','-vsa']
+ppg_env=dict(os.environ,DEBUG_CPU_EXEC='TRUE',INSPECT_TXP='TRUE')
 
 ## Create Results
 #-------------------------------
+# up to PIPELINE_DEPTH files are in flight, so decoding the next file overlaps with translating the current one
+running=deque()
 for input_file in input_files:
+    if len(running)>=PIPELINE_DEPTH:
+        finish_file(*running.popleft())
     print(f'Generatating personalized proteomes from: {input_file} ...')
+    # build the paths used by the current file once 
+    stem=input_file.split('.',1)[0]
+    in_path=f'{INPUT_PATH}/{input_file}'
+    out_dir=f'{OUTPUT_PATH}/{stem}_protoems'
+    log_path=f'{LOG_DIR}/{stem}.vcfDebug_logs'
     # create a file to hold the results 
-    output_path=os.path.join(OUTPUT_PATH,input_file.split('.')[0])
     try: 
-        os.mkdir(output_path+"_protoems") # make the output file 
-    except FileExistsError: 
-        pass
+        os.makedirs(out_dir,exist_ok=True) # make the output file 
     except Exception as exp: 
         print(f'While creating a file to hold the results of file: {input_file} the following error was encounter {str(exp)}')
-    # generating the vcf_file
-    vcf_file_name=input_file.split('.')[0]+'.vcf'
-    # generate the file 
-    try:
-        sp.run(f'module load bcftools; bcftools view -S {LIST_SAMPLES} --threads 16 {os.path.join(INPUT_PATH,input_file)} -O v -o {os.path.join(OUTPUT_PATH,vcf_file_name)}',
-            check=True, shell=True)
-    except sp.SubprocessError as exp: 
-        print(f'Trying to generate the vcf file failed with the following error: {str(exp)}')
-        continue
-    # extract the target transcripts  
+    # decode the bcf file, extract the header and the target transcripts and stream them directly into ppg, no vcf file is written to disk
     try:
-        sp.run(f"grep -F '#' {os.path.join(OUTPUT_PATH,vcf_file_name)} > {os.path.join(OUTPUT_PATH,vcf_file_name.strip('.vcf')+'_mini.vcf')}",shell=True,check=True) # grep the header
-        sp.run(f"grep -E '{'|'.join(txp_list)}' {os.path.join(OUTPUT_PATH,vcf_file_name)} >> {os.path.join(OUTPUT_PATH,vcf_file_name.strip('.vcf')+'_mini.vcf')}",shell=True,check=True) # extracts the transcripts
-    except sp.SubprocessError as exp:
-        print(f'Trying to focus on the target transcript from the file cause the following error: {str(exp)}')
-    # remove from the major files
-    try:
-        sp.run(f"rm -rf {os.path.join(OUTPUT_PATH,vcf_file_name)}",shell=True,check=True)
-    except sp.SubprocessError as exp:
-        print(f'Trying to remove the original file failed with the following error: {str(exp)}')
-    # call ppg
-    try: 
-        sp.run(f"export DEBUG_CPU_EXEC=TRUE; export INSPECT_TXP=TRUE; ./Vcf2prot -f {os.path.join(OUTPUT_PATH,vcf_file_name.strip('.vcf')+'_mini.vcf')} -r {REF_PATH} -o {output_path+'_protoems'} -g mt -vsa &> {os.path.join(TEMP_DIR,vcf_file_name+'Debug_logs')} ", 
-            check=True, shell=True)
-    except sp.SubprocessError as exp: 
+        running.append((input_file,start_pipeline([bcftools_argv+[in_path],grep_argv,ppg_argv+['-o',out_dir]],log_path,ppg_env)))
+    except OSError as exp: 
         print(f'Trying to generate the personalized proteomes failed with the following error:{str(exp)}')
         pass 
+while running:
+    finish_file(*running.popleft())
+# all pipelines have finished reading the patterns 
+os.unlink(pattern_file)
 print(f'Execution finished')
@@ -11,17 +11,15 @@ import time
 import os
 import subprocess as sp 
 from typing import List 
+import tempfile
+import atexit
+import shutil
 from concurrent import futures
-import random 
-try: 
-    import pandas as pd 
-except ModuleNotFoundError:
-    os.system("pip install pandas")
-import concurrent.futures
 try: 
     from tqdm import tqdm 
 except ModuleNotFoundError:
     os.system("pip install tqdm")
+from pipeline_tools import start_pipeline, wait_pipeline
 ## record the start time
 #-----------------------
 start_time=time.ctime()
@@ -31,18 +29,20 @@ parser=argparse.ArgumentParser(description="A wrapper for ppg, can be used for e
     and call ppg on the generate batch to generated personalized proteome for each patient in the extracted batch. Different batches are executed concurrently\
         using a pool of processes")
 
-parser.add_argument("-f,--file",help="The path to the input bcf.gz file", default='?')
-parser.add_argument("-r,--ref", help="The path to the reference fasta file", default="?")
-parser.add_argument("-o,--output_file", help="The path to write the generated fasta sequences, defaults to the current working directory",
-                    defaults=os.getcwd())
-parser.add_argument("-t,--temp_dir", help="The path to a temp directory to store VCF files, defaults to the current working directory",
-                    defaults=os.getcwd())
-parser.add_argument("-w,--num_workers", help="number of worker processes, defaults to number of available CPU cores", 
-                            default=os.cpu_count())
-parser.add_argument("-b, --batch_size",help="The number of patients in a batch, defaults to 100", default=100, type=int)
-parser.add_argument("-e,--exe", help="The path to ppg executables",default=None)
-parser.add_argument('-k,--set_input_name_as_base',help="A boolean switch for controlling the writting output, if True, a directory with\
-    same name as the input is created in the output directory and the temp directory, where files will be written.", default=False, action='store_true')
+parser.add_argument("-f","--file",help="The path to the input bcf.gz file", default='?')
+parser.add_argument("-r","--ref", help="The path to the reference fasta file", default="?")
+parser.add_argument("-o","--output_dir", help="The path to write the generated fasta sequences, defaults to the current working directory",
+                    default=os.getcwd())
+parser.add_argument("-t","--temp_dir", help="The path to a directory where a private temp directory is created for each run to store the VCF file of\
+    each batch, the temp directory is removed at the end of the run. Defaults to the environmental variable VCF2PROT_TMP or to /dev/shm if it is not set,\
+    i.e. the VCF files are kept in memory",
+                    default=os.environ.get('VCF2PROT_TMP','/dev/shm'))
+parser.add_argument("-w","--num_workers", help="number of worker processes, defaults to number of available CPU cores", 
+                            default=os.cpu_count(), type=int)
+parser.add_argument("-b","--batch_size",help="The number of patients in a batch, defaults to 100", default=100, type=int)
+parser.add_argument("-e","--exe", help="The path to ppg executables",default=None)
+parser.add_argument('-k','--set_input_name_as_base',help="A boolean switch for controlling the writting output, if True, a directory with\
+    same name as the input is created in the output directory and the name of the temp directory starts with the name of the input, where files will be written.", default=False, action='store_true')
 ## Parse user provided arguments 
 #-------------------------------
 args=parser.parse_args()
@@ -54,8 +54,10 @@ elif not os.path.exists(args.file):
 # Check that the reference file exist 
 if args.ref=="?":
         raise ValueError("Reference Fasta file has not been provided")
-elif not os.path.exists(args.file):
-    raise ValueError(f"The provided path: {args.file} does not exist!!")
+elif not os.path.exists(args.ref):
+    raise ValueError(f"The provided path: {args.ref} does not exist!!")
+# the estimated ratio between the size of the decoded VCF text and the compressed BCF file, used to check the free space of the temp directory 
+VCF_EXPANSION_FACTOR=30
 # the path of the executable to the path 
 ## define an analysis function 
 def get_patient_name(path2file:str, path2temp:str)->None:
@@ -67,56 +69,60 @@ def get_patient_name(path2file:str, path2temp:str)->None:
         path2temp (str): The path to the temp directory
     """
     try: 
-        sp.run(f"bcftools query -l {path2file} > {os.path.join(path2temp,'name_probands.txt')}")
-    except sp.SubprocessError as exp:
+        with open(os.path.join(path2temp,'name_probands.txt'),'wb') as names_fd:
+            sp.run(['bcftools','query','-l',path2file],stdout=names_fd,check=True)
+    except (sp.SubprocessError,OSError) as exp:
         raise ValueError(f"Getting the probands names failed with the following error code: {str(exp)}")
     return
 
-def load_patient_name(path2file:str)->pd.DataFrame:
-    """Load patient names into a pd.DataFrame
+def load_patient_name(path2file:str)->List[str]:
+    """Load patient names into a list
 
     Args:
         path2file (str): The path to a text file containing the name of each patient in the BCF compressed file
 
     Returns:
-        pd.DataFrame: a table of the results
+        List[str]: a list containing the name of each patient
     """
     try: 
-        names=pd.read_csv(path2file,header=None)
+        with open(path2file) as reader_file:
+            names=reader_file.read().splitlines()
     except Exception as exp:
         raise IOError(f"Loading the patient names failed with the following error: {str(exp)}")
     return names
 
-def extract_patient_from_bcf_compressed(path2file:str, patients: List[str], path2temp:str)->str:
-    """ Extract a batch of samples from the compressed BCF file and write them on parallel to a BCF File 
+def extract_patient_from_bcf_compressed(path2file:str, batches: List[List[str]], path2temp:str)->List[str]:
+    """ Extract all batches of samples from the compressed BCF file in one pass and write each batch to a VCF file, \
+        the BCF file is decoded once and split among the batches using the bcftools split plugin. 
 
     Args:
         path2file (str): the path the VCF file 
-        patients (List[str]): a list containing the name of patient to extract their data from the file 
-        path2temp (str): the path to the temp directory, where the vcf file will be written
+        batches (List[List[str]]): a list of batches, each is a list containing the name of patient to extract their data from the file 
+        path2temp (str): the path to the temp directory, where the vcf files will be written
 
     Returns:
-        str: the absolute path to the generate VCF file 
+        List[str]: the absolute path to the generated VCF file of each batch 
     """
-    # 1. write patient names to a text file in the temp directory 
-    # 1.a generate a randome identifier 
-    batch_identifer=str(random.randint(int(1e6),int(1e7)))
-    # 1.b create a file name 
-    file_path=os.path.join(path2temp,'patinet_batch_'+batch_identifer+'list_patient.txt')
-    # 1.c write patient names on parallel
+    # 1. write the batch of each patient to a groups file in the temp directory 
     try:
-        with open(file_path,'w') as writer_file:
-            for patient in patients:
-                writer_file.write(patient+'\n')
+        # 1.a atomically create a uniquely named groups file, its name is the identifier of the batches 
+        file_descriptor, file_path=tempfile.mkstemp(prefix='patient_batch_',suffix='_groups.txt',dir=path2temp)
+        batch_identifer=os.path.basename(file_path)[:-len('_groups.txt')]
+        # 1.b create a name for the vcf file of each batch
+        batch_names=[f'{batch_identifer}_{batch_idx}_alterations' for batch_idx in range(len(batches))]
+        # 1.c write patient names and their batch in one call
+        with os.fdopen(file_descriptor,'w') as writer_file:
+            writer_file.write(''.join(f'{patient}\t{batch_name}\n' for batch_name, patients in zip(batch_names,batches) for patient in patients))
     except Exception as exp: 
-        raise IOError(f"Writing the patients file to the path: {file_path}, failed with the following error: {str(exp)}")
-    # 2- extract a vcf file from a bcf file 
-    result_file=os.path.join(path2temp,'patinet_batch_'+batch_identifer+'alterations.vcf')
+        raise IOError(f"Writing the patients file to the temp directory: {path2temp}, failed with the following error: {str(exp)}")
+    # 2- decode the bcf file once and split it into one vcf file per batch
     try:
-        sp.run(f"bcftools view -c1 -Ov -S {os.path.abspath(file_path)} -o {os.path.abspath(result_file)} {os.path.abspath(path2file)}")
-    except sp.SubprocessError as exp:
-        raise RuntimeError(f"Extracting the batch of data, failed with the following error: {str(exp)}")
-    return result_file
+        # as -c1 on the whole cohort keeps sites altered in any batch, the split plugin drops sites without an alt allele in each batch
+        wait_pipeline(start_pipeline([['bcftools','view','-c1','-Ou',os.path.abspath(path2file)],
+                        ['bcftools','+split','-G',os.path.abspath(file_path),'-i','GT="alt"','-Ov','-o',os.path.abspath(path2temp)]]))
+    except (sp.SubprocessError,OSError) as exp:
+        raise RuntimeError(f"Extracting the batches of data, failed with the following error: {str(exp)}")
+    return [os.path.join(os.path.abspath(path2temp),batch_name+'.vcf') for batch_name in batch_names]
 
 def worker_function(path2chunK:str, path2ref:str, result_path:str)->None:
     """Runs ppg with the provided batch of probands on a separate process
@@ -131,45 +137,43 @@ def worker_function(path2chunK:str, path2ref:str, result_path:str)->None:
     """
     try:
         if args.exe==None:
-            sp.run(f"ppg_rust -f {path2chunK} -r {path2ref}, -o {result_path} -g st",
+            sp.run(['ppg_rust','-f',path2chunK,'-r',path2ref,'-o',result_path,'-g','st'],
                                 stdout=sp.DEVNULL,check=True)
         else:
-            sp.run(f".{args.exe}/ppg_rust -f {path2chunK} -r {path2ref}, -o {result_path} -g st",
+            sp.run([os.path.join(args.exe,'ppg_rust'),'-f',path2chunK,'-r',path2ref,'-o',result_path,'-g','st'],
                                 stdout=sp.DEVNULL,check=True)
     except sp.SubprocessError as exp:
         raise RuntimeError(f"Calling ppg with the following chunk failed: {path2chunK}")
+    finally:
+        # free the memory used by the chunk
+        try:
+            os.unlink(path2chunK)
+        except FileNotFoundError:
+            pass
 
-def personalization_task(path2file:str,patients:List[str], path2temp:str, path2ref:str, path2res:str)->None:
-    """ Extract the genomic alteration of a batch of patients from a VCF file, write the results to a VCF file\
-         and call ppg to generate the personalized Fasta sequences. 
-
-    Args:
-        path2file (str): the path the VCF file. 
-        patients (List[str]): a list containing the name of patient to extract their data from the file. 
-        path2temp (str): The path to the temp directory, where the vcf file will be written.
-        path2temp (str): The path to the reference FASTA file.
-        path2res (str): The path to write the generated Fasta Files 
-    """
-    # 1. extract vcf files: 
-    path2vcf=extract_patient_from_bcf_compressed(path2file,patients,path2temp)
-    # 2. generating the results
-    worker_function(path2vcf,path2ref,path2res)
-    return
 ## Start the execution part of the script 
 #----------------------------------------
-# 1. Create a temp directory 
-if os.path.exists(args.temp_dir) and not args.set_input_name_as_base:
-    pass
-else: 
-    try:
-        if args.set_input_name_as_base:
-            base_dir=args.file.split('/')[-1].split('.')[0] 
-            args.temp_dir=os.path.join(args.temp_dir,base_dir)
-            os.mkdir(args.temp_dir)
-        else:
-            os.mkdir(args.temp_dir)
-    except Exception as exp:
-        raise RuntimeError(f"Creating a temp directory failed with the following error:{str(exp)}") 
+# 1. Create a temp directory for this run 
+# 1.a the split plugin writes the decoded VCF of every batch before any worker starts, i.e. one uncompressed copy of the whole cohort,
+# hence, fallback to the node local scratch if the temp directory, e.g. tmpfs, does not have enough room for it 
+required_space=VCF_EXPANSION_FACTOR*os.path.getsize(args.file)
+temp_root=args.temp_dir
+try:
+    os.makedirs(temp_root,exist_ok=True)
+    if shutil.disk_usage(temp_root).free < required_space:
+        temp_root=os.environ.get('TMPDIR','/tmp')
+        if shutil.disk_usage(temp_root).free < required_space:
+            raise RuntimeError(f"Neither the temp directory: {args.temp_dir} nor the local scratch: {temp_root} have the estimated {required_space} bytes\
+                needed for the decoded VCF files, please provide a temp directory with enough free space")
+        print(f"The temp directory: {args.temp_dir} does not have enough free space, the local scratch: {temp_root} will be used instead")
+    # 1.b the temp root is shared by all jobs and users on the node, hence, each run gets its own private directory which is removed at exit
+    temp_prefix='vcf2prot_'
+    if args.set_input_name_as_base:
+        temp_prefix+=args.file.split('/')[-1].split('.')[0]+'_'
+    args.temp_dir=tempfile.mkdtemp(prefix=temp_prefix,dir=temp_root)
+    atexit.register(shutil.rmtree,args.temp_dir,True)
+except OSError as exp:
+    raise RuntimeError(f"Creating a temp directory failed with the following error:{str(exp)}") 
 # 2. Create an output directory 
 if os.path.exists(args.output_dir) and not args.set_input_name_as_base:
     pass
@@ -178,33 +182,24 @@ else:
         if args.set_input_name_as_base:
             base_dir=args.file.split('/')[-1].split('.')[0] 
             args.output_dir=os.path.join(args.output_dir,base_dir)
-            os.mkdir(args.output_dir)
+            os.makedirs(args.output_dir,exist_ok=True)
         else:
-            os.mkdir(args.output_dir)
+            os.makedirs(args.output_dir,exist_ok=True)
     except Exception as exp:
-        raise RuntimeError(f"Creating a temp directory failed with the following error:{str(exp)}") 
+        raise RuntimeError(f"Creating an output directory failed with the following error:{str(exp)}") 
 # 3. Create a list of patient 
-get_patient_name(args.input_file,args.temp_dir)
+get_patient_name(args.file,args.temp_dir)
 # 4. load the patient name as a list of names
-patient_names=load_patient_name(os.path.join(args.temp_dir,'name_probands.txt')).iloc[:,0].to_list()
+patient_names=load_patient_name(os.path.join(args.temp_dir,'name_probands.txt'))
 # 5. distribute the load among different processes 
-# 5.1 create a list to hold future objects
-jobs=[]
-# 5.2 compute the load of each process
-load=patient_names.shape[0]/args.batch_size
+# 5.1 split the patients among the batches
+batches=[patient_names[idx:idx+args.batch_size] for idx in range(0,len(patient_names),args.batch_size)]
+print(f"The {len(patient_names)} patients have been split into {len(batches)} batches")
+# 5.2 extract the vcf file of all batches in one pass over the bcf file 
+path2batches=extract_patient_from_bcf_compressed(args.file,batches,args.temp_dir)
 # 5.3 create a workers pool and submit jobs to the cluster
 with futures.ProcessPoolExecutor(args.num_workers) as workers_pool:
-    for idx in range(0,patient_names-load,load):
-        jobs.append(
-            workers_pool.submit(
-                personalization_task, args.file, patient_names[idx:idx+load],args.temp_dir, args.ref, args.output_file
-            )
-        )
-    # push the last file 
-    if idx !=len(patient_names):
-        workers_pool.submit(
-                personalization_task, args.file, patient_names[idx:],args.temp_dir, args.ref, args.output_file
-            )
+    jobs=[workers_pool.submit(worker_function, path2batch, args.ref, args.output_dir) for path2batch in path2batches]
 # 5.3 collect the results 
 # 5.3.1 initialize counters for success abd failed jobs
 num_success=0
@@ -9,11 +9,20 @@ import os
 import time 
 import logging
 import subprocess as sp 
-import pickle
+import json
+import shutil
+import concurrent.futures
+import multiprocessing
+from typing import List
+from itertools import accumulate
 try:
     from tqdm import tqdm
 except ModuleNotFoundError:
     os.system("pip install tqdm")
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    raise ModuleNotFoundError("numpy is needed to store the benchmark results, install it with: pip install numpy")
 ## define constant parameters 
 #---------------------------------------
 NUM_RUNS_PER_TRIAL=10 
@@ -23,70 +32,177 @@ INPUT_REF='/work_ifs/sukmb418/ppg_paper/References_sequences.fasta'
 TEMP_WORK_DIR='/work_ifs/sukmb418/ppg_paper/temp_work'
 TEMP_RESULTS_PATH='/work_ifs/sukmb418/ppg_paper/res'
 RESULT_PATH='/work_ifs/sukmb418/ppg_paper/benchmark_results'
+THREADS_PER_RUN=16 # the number of cores reserved for each concurrently benchmarked patient size
+USE_RT_PRIORITY=False # if set, runs are executed with a real-time round-robin priority, requires CAP_SYS_NICE
+USE_HIGH_PRIORITY=False # if set, runs are executed with nice -n -5 and the real-time I/O class of ionice, requires root or CAP_SYS_NICE/CAP_SYS_ADMIN
+# the cores the benchmark is allowed to use, e.g. under a SLURM or cgroup CPU limit this is less than os.cpu_count()
+AVAILABLE_CORES=sorted(os.sched_getaffinity(0)) if hasattr(os,'sched_getaffinity') else list(range(os.cpu_count()))
 #---------------------------------------
 ## variable parameter
 engines=['st','mt','gpu']
 num_patients=[1,2,4,8,16,32,64,128,256,512,1024,2048,4096,8192,16384]
 use_single_thread_write=[True,False]
-print(f"Number of runs is: {(NUM_RUNS_PER_TRIAL+NUM_DISK_WARM_UP)*len(engines)*len(num_patients)*len(use_single_thread_write)}")
-#------------------------------------------
-## create an initialize a dictionary to store the results 
-bench_mark_results={  ## loop over the number of patient  
-                    elem:{ ## for each trial we loop over engines 
-                            eng:{ ## for each engine we loop over wether or not a single thread are used for writting 
-                                'single_thread_state'+str(state): []  for state in  use_single_thread_write ## finally we store the number of state in a single thread
-                                } for eng in engines 
-                            } 
-                        for elem in num_patients
-                    }
+# CPU engines of different patient sizes are benchmarked concurrently, while runs on the GPU are executed one at a time
+cpu_engines=[eng for eng in engines if eng!='gpu']
+gpu_engines=[eng for eng in engines if eng=='gpu']
+num_passes=int(len(cpu_engines)!=0)+int(len(gpu_engines)!=0) # each pass warms the disk up once per patient size
+print(f"Number of runs is: {(num_passes*NUM_DISK_WARM_UP+NUM_RUNS_PER_TRIAL*len(engines)*len(use_single_thread_write))*len(num_patients)}")
 #------------------------------------------
 ## create a logging file 
 logging.basicConfig(filename='runs_log.log',encoding='utf-8',
                     level=logging.DEBUG,format='%(asctime)s %(message)s')
-print(f"Starting the benchmarking loop: time is --> {time.ctime()}")
 #------------------------------------------
-counter=0
-for num_pat in tqdm(num_patients):
-    # cut the number of patient from the vcf file 
-    os.system(f"cut -f 1-{9+num_pat} {INPUT_VCF} > {os.path.join(TEMP_WORK_DIR,f'run_file_with_{num_pat}_patient.vcf')}") # files will be override so we can clean once at the end
-    logging.info(f"Creating the runs input VCF file, the file contains: {num_pat} patients")
-    for engine in engines:
-        logging.info("Benchmarking with engine {engine}")
+## define the input preparation function
+def cut_patient_files(path2vcf:str, patient_sizes:list, path2work:str)->dict:
+    """Write one VCF file per patient size containing the 9 fixed columns and the first patients of the input VCF,\
+        as every file is a column-prefix of the input all files are written in a single pass over the input.
+
+    Args:
+        path2vcf (str): The path to the input VCF file
+        patient_sizes (list): A list of the number of patients to keep in each file
+        path2work (str): The path to the directory where the files will be written
+
+    Returns:
+        dict: a dict linking each patient size to the path of its VCF file
+    """
+    patient_sizes=sorted(patient_sizes)
+    max_cols=9+patient_sizes[-1]
+    run_files={num_pat:os.path.join(path2work,f'run_file_with_{num_pat}_patient.vcf') for num_pat in patient_sizes}
+    writers=[open(run_files[num_pat],'wb') for num_pat in patient_sizes]
+    try:
+        with open(path2vcf,'rb') as reader_stream:
+            for line in reader_stream:
+                line=line.rstrip(b'\n')
+                # the tabs are located in C by split, the end of the k-th column is the sum of the lengths of the first k columns plus their tabs
+                fields=line.split(b'\t',max_cols)
+                col_ends=list(accumulate(len(field)+1 for field in fields[:max_cols]))
+                for num_pat,writer in zip(patient_sizes,writers):
+                    num_cols=9+num_pat
+                    writer.write(line[:col_ends[num_cols-1]-1]+b'\n' if num_cols<len(fields) else line+b'\n')
+    finally:
+        for writer in writers:
+            writer.close()
+    return run_files
+## define a function to warm the page cache
+def warm_page_cache(path2file:str)->None:
+    """Ask the kernel to read the file into the page cache asynchronously, the call returns immediately and\
+        the readahead overlaps with the following work. On platforms without posix_fadvise, e.g. Mac OS, this is a no-op.
+
+    Args:
+        path2file (str): The path to the file to load into the page cache
+    """
+    if not hasattr(os,'posix_fadvise'):
+        return
+    file_descriptor=os.open(path2file,os.O_RDONLY)
+    try:
+        os.posix_fadvise(file_descriptor,0,0,os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(file_descriptor)
+## define a function to pin the benchmarking processes
+def pin_worker(slot_counter)->None:
+    """Pin the calling worker process to its own set of THREADS_PER_RUN cores, ppg runs launched by the worker inherit the\
+        affinity, hence, they are not migrated between cores or NUMA nodes. On platforms without sched_setaffinity, e.g. Mac OS, this is a no-op.
+
+    Args:
+        slot_counter (multiprocessing.Value): A shared counter used to give each worker a distinct set of cores
+    """
+    if not hasattr(os,'sched_setaffinity'):
+        return
+    with slot_counter.get_lock():
+        slot=slot_counter.value
+        slot_counter.value+=1
+    cores=AVAILABLE_CORES[slot*THREADS_PER_RUN:(slot+1)*THREADS_PER_RUN]
+    if len(cores)!=0:
+        os.sched_setaffinity(0,cores)
+#------------------------------------------
+## define the benchmarking function
+def run_trial(num_pat:int, trial_engines:List[str])->List[dict]:
+    """Benchmark the provided engines with all writing modes on a VCF file containing the first num_pat patients, runs are executed\
+        serially within a patient size so that timed runs of the same size do not compete with each other.
+
+    Args:
+        num_pat (int): The number of patients to cut from the input VCF file
+        trial_engines (List[str]): The engines to benchmark
+
+    Returns:
+        List[dict]: a list of records, one per timed run, containing the engine, the writing state and the runtime of the run
+    """
+    # each patient size has its own input file and result directory, so trials can run concurrently
+    run_file=os.path.join(TEMP_WORK_DIR,f'run_file_with_{num_pat}_patient.vcf') # generated by cut_patient_files
+    pat_results_path=os.path.join(TEMP_RESULTS_PATH,f'pat_{num_pat}')
+    os.makedirs(pat_results_path,exist_ok=True)
+    # concurrent trials might have evicted the inputs, hence, they are loaded back before the runs start
+    warm_page_cache(run_file)
+    warm_page_cache(INPUT_REF)
+    ## create a list to store the record of each run 
+    trial_results=[]
+    # the environment and the argv are prepared once, so runs do not pay for starting a shell
+    ppg_env=dict(os.environ,DEBUG_GPU='TRUE',INSPECT_TXP='TRUE',INSPECT_INS_GEN='TRUE')
+    # once a file is cached it is cached for all engines and writing states, hence, the disk is warmed up once per patient size
+    for idx in range(NUM_DISK_WARM_UP):
+        sp.run(['./ppgg_rust','-f',run_file,'-r',INPUT_REF,'-o',pat_results_path,'-g',trial_engines[0],'-v'],
+                env=ppg_env,stdout=sp.DEVNULL,check=True)
+    for engine in trial_engines:
+        logging.info(f"Benchmarking with engine {engine} on {num_pat} patients")
         for use_single_write in use_single_thread_write:
-            for idx in range(NUM_DISK_WARM_UP+NUM_RUNS_PER_TRIAL): 
-                if use_single_write:
-                    state_time=time.time()
-                    sp.run(f"export DEBUG_GPU=TRUE &&\
-                        export INSPECT_TXP=TRUE&&\
-                        export INSPECT_INS_GEN=TRUE&&\
-                        ./ppgg_rust -f {os.path.join(TEMP_WORK_DIR,f'run_file_with_{num_pat}_patient.vcf')}\
-                             -r {INPUT_REF} -o {TEMP_RESULTS_PATH} -g {engine} -wv",
-                                stdout=sp.DEVNULL,check=True,shell=True) # incase execution failed for whatever reason the whole script shall fail 
-                    end_time=time.time()
-                else:
-                    state_time=time.time()
-                    sp.run(f"export DEBUG_GPU=TRUE &&\
-                        export INSPECT_TXP=TRUE&&\
-                        export INSPECT_INS_GEN=TRUE&&\
-                        ./ppgg_rust -f {os.path.join(TEMP_WORK_DIR,f'run_file_with_{num_pat}_patient.vcf')}\
-                             -r {INPUT_REF} -o {TEMP_RESULTS_PATH} -g {engine} -wv",
-                                stdout=sp.DEVNULL,check=True,shell=True)
-                    end_time=time.time()
-                bench_mark_results[num_pat][engine]['single_thread_state'+str(use_single_write)].append(end_time-state_time)
-                counter+=1
-                if counter%20==0:
-                    print(f"Current number of iterations is: {counter}, expected number of iterations is: 1080, progress is: {(counter/1080)*100}%")
-                if counter%100==0: ## This is 
-                    with open(f"{os.path.join(RESULT_PATH,f'results_at_{counter}_cycle.pickle')}",'wb') as writer_stream:
-                        pickle.dump(bench_mark_results,writer_stream)                         
-## Write the final results 
-with open(f"{os.path.join(RESULT_PATH,f'results_at_{counter}_cycle.pickle')}",'wb') as writer_stream:
-                        pickle.dump(bench_mark_results,writer_stream)   
-## Print a final progress statement and clean up the temp results 
-print(f"The benchmark finished at: {time.ctime()}")
-print(f"Cleaning temp results and directories ...")
-print(f"removing the temp work directory ... starting at {time.ctime()}")
-os.system(f"rm -rf {TEMP_WORK_DIR}/*")
-print(f"removing the generated fasta files ... starting at  {time.ctime()}")
-os.system(f"rm -rf {TEMP_RESULTS_PATH}/*")
-print(f"Execution finished at: {time.ctime()}")
+            ppg_argv=(['nice','-n','-5','ionice','-c1'] if USE_HIGH_PRIORITY else [])+(['chrt','-r','10'] if USE_RT_PRIORITY else [])+['./ppgg_rust','-f',run_file,'-r',INPUT_REF,'-o',pat_results_path,'-g',engine,'-v']
+            if use_single_write:
+                ppg_argv.append('-w')
+            for idx in range(NUM_RUNS_PER_TRIAL): 
+                state_time=time.perf_counter_ns()
+                sp.run(ppg_argv,env=ppg_env,stdout=sp.DEVNULL,check=True) # incase execution failed for whatever reason the whole script shall fail 
+                end_time=time.perf_counter_ns()
+                trial_results.append({'num_pat':num_pat,'engine':engine,'single_write':use_single_write,
+                                    'run_idx':idx,'runtime':(end_time-state_time)/1e9})
+    return trial_results
+#------------------------------------------
+if __name__=='__main__':
+    # cut the number of patient from the vcf file, files will be override so we can clean once at the end
+    cut_patient_files(INPUT_VCF,num_patients,TEMP_WORK_DIR)
+    logging.info(f"Created the runs input VCF files, the files contain: {num_patients} patients")
+    print(f"Starting the benchmarking loop: time is --> {time.ctime()}")
+    counter=0
+    ## preallocate an array to store the runtimes, indexed by engine, number of patients, writing state and run
+    bench_mark_results=np.full((len(engines),len(num_patients),len(use_single_thread_write),NUM_RUNS_PER_TRIAL),
+                                np.nan,dtype=np.float64)
+    engine_idx={eng:idx for idx,eng in enumerate(engines)}
+    num_pat_idx={num_pat:idx for idx,num_pat in enumerate(num_patients)}
+    state_idx={state:idx for idx,state in enumerate(use_single_thread_write)}
+    # the record of each run is appended to a JSON-lines file as soon as its patient size is finished,
+    # the file is shared by all invocations, hence, each record is tagged with the start time and the pid of the invocation 
+    run_id=f"{time.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}"
+    with open(os.path.join(RESULT_PATH,'benchmark_results.jsonl'),'a',buffering=1<<16) as writer_stream:
+        def store_records(records:List[dict])->None:
+            """Append the records of a finished trial to the JSON-lines file and to the results array"""
+            for record in records:
+                writer_stream.write(json.dumps(dict(record,run_id=run_id))+'\n')
+                bench_mark_results[engine_idx[record['engine']],num_pat_idx[record['num_pat']],
+                                    state_idx[record['single_write']],record['run_idx']]=record['runtime']
+            writer_stream.flush()
+        # patient sizes are independent of each other, hence, they are benchmarked concurrently on the CPU engines,
+        # note that these timings are taken while the other patient sizes share the memory bandwidth and the file system 
+        if len(cpu_engines)!=0:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max(1,len(AVAILABLE_CORES)//THREADS_PER_RUN),
+                                    initializer=pin_worker,initargs=(multiprocessing.Value('i',0),)) as workers_pool:
+                jobs={workers_pool.submit(run_trial,num_pat,cpu_engines):num_pat for num_pat in num_patients}
+                for job in tqdm(concurrent.futures.as_completed(jobs),total=len(jobs)):
+                    store_records(job.result())
+                    counter+=1
+                    print(f"Benchmarking {jobs[job]} patients on the CPU finished, {counter} out of {len(num_patients)} patient sizes are done")
+        # there is one GPU, hence, the GPU engine is benchmarked in a separate serial pass after all CPU runs have finished 
+        if len(gpu_engines)!=0:
+            for num_pat in tqdm(num_patients):
+                store_records(run_trial(num_pat,gpu_engines))
+                print(f"Benchmarking {num_pat} patients on the GPU finished")
+    ## Write the final results, the axes of the array follow the order of engines, num_patients and use_single_thread_write 
+    np.save(os.path.join(RESULT_PATH,'benchmark_results.npy'),bench_mark_results)
+    ## Print a final progress statement and clean up the temp results 
+    print(f"The benchmark finished at: {time.ctime()}")
+    print(f"Cleaning temp results and directories ...")
+    print(f"removing the temp work directory ... starting at {time.ctime()}")
+    shutil.rmtree(TEMP_WORK_DIR,ignore_errors=True)
+    os.makedirs(TEMP_WORK_DIR,exist_ok=True)
+    print(f"removing the generated fasta files ... starting at  {time.ctime()}")
+    shutil.rmtree(TEMP_RESULTS_PATH,ignore_errors=True)
+    os.makedirs(TEMP_RESULTS_PATH,exist_ok=True)
+    print(f"Execution finished at: {time.ctime()}")
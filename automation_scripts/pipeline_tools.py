@@ -0,0 +1,65 @@
+"""
+@brief: Helper functions shared by the automation scripts for running chains of commands, e.g. bcftools piped into ppg,
+as pipelines of processes without a shell.
+"""
+## Load the modules
+#------------------
+import contextlib
+import signal
+import subprocess as sp
+from typing import List, Optional
+## Define the pipeline functions
+#--------------------------------
+def start_pipeline(argvs:List[List[str]], log_path:Optional[str]=None, env:dict=None)->List[sp.Popen]:
+    """Start the provided commands as a pipeline without waiting for it, the stdout of each command is fed into the stdin\
+        of the next command and the output of the last command is written to the log file, if one is provided.
+
+    Args:
+        argvs (List[List[str]]): the argv of each command in the pipeline
+        log_path (Optional[str], optional): the path to the log file of the last command, defaults to None, i.e. the last command writes to\
+            the stdout and the stderr of the script
+        env (dict, optional): the environment of the commands, defaults to the environment of the script
+
+    Returns:
+        List[sp.Popen]: the running processes of the pipeline
+    """
+    procs=[]
+    try:
+        with open(log_path,'wb',buffering=0) if log_path is not None else contextlib.nullcontext() as log_fd:
+            for idx, argv in enumerate(argvs):
+                is_last=idx==len(argvs)-1
+                procs.append(sp.Popen(argv,stdin=procs[-1].stdout if procs else None,stdout=log_fd if is_last else sp.PIPE,
+                                    stderr=sp.STDOUT if is_last and log_fd is not None else None,env=env))
+                if len(procs)>1:
+                    procs[-2].stdout.close() # only the next process holds the read end, so a process stops if the next one exits early
+    except OSError:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    return procs
+
+def wait_pipeline(procs:List[sp.Popen])->None:
+    """Wait for all processes of a pipeline to finish
+
+    Args:
+        procs (List[sp.Popen]): the running processes of the pipeline
+
+    Raises:
+        sp.SubprocessError: incase any of the processes failed, all failed processes are reported starting from the last one
+    """
+    for proc in reversed(procs):
+        proc.wait()
+    # the stages upstream of a failed stage usually die of SIGPIPE, hence, the downstream stages are reported first
+    failures=[f"'{' '.join(map(str,proc.args))}' exited with status {proc.returncode}"+
+                (" (SIGPIPE, the next stage stopped reading)" if proc.returncode==-signal.SIGPIPE else "")
+                for proc in reversed(procs) if proc.returncode!=0]
+    if len(failures)!=0:
+        raise sp.SubprocessError("The pipeline failed: "+"; ".join(failures))
+
+def finish_file(input_file:str, procs:List[sp.Popen])->None:
+    """Wait for the pipeline of an input file and report if it failed"""
+    try:
+        wait_pipeline(procs)
+    except sp.SubprocessError as exp: 
+        print(f'Trying to generate the personalized proteomes from: {input_file} failed with the following error:{str(exp)}')